@@ -1,18 +1,30 @@
-import json
+import csv
+import itertools
+import os
 import uuid
 
+import orjson
+import requests
 import typer
 import validators
 from googleapiclient.discovery import build
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2 import service_account
 import yaml
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime
 from pathlib import Path
 from enum import Enum
 from typing import Optional, NamedTuple
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader
 
 extractor = typer.Typer()
 APP_NAME = "ga-extractor"
+BATCH_GET_URL = "https://analyticsreporting.googleapis.com/v4/reports:batchGet"
 
 
 class SamplingLevel(str, Enum):
@@ -29,12 +41,14 @@ class OutputFormat(str, Enum):
 
     @staticmethod
     def file_suffix(f):
-        format_mapping = {
-            OutputFormat.JSON: "json",
-            OutputFormat.CSV: "csv",
-            OutputFormat.UMAMI: "sql",
-        }
-        return format_mapping[f]
+        return FILE_SUFFIXES[f]
+
+
+FILE_SUFFIXES = {
+    OutputFormat.JSON: "json",
+    OutputFormat.CSV: "csv",
+    OutputFormat.UMAMI: "sql",
+}
 
 
 class Preset(str, Enum):
@@ -121,9 +135,10 @@ def auth():
         return
     try:
         with config_path.open() as config:
-            credentials = service_account.Credentials.from_service_account_file(yaml.safe_load(config)["serviceAccountKeyPath"])
+            credentials = service_account.Credentials.from_service_account_file(yaml.load(config, Loader=SafeLoader)["serviceAccountKeyPath"])
             scoped_credentials = credentials.with_scopes(['openid'])
-        with build('oauth2', 'v2', credentials=scoped_credentials) as service:
+        # Explicitly pinned to the bundled discovery document (already the default in google-api-python-client 2.x)
+        with build('oauth2', 'v2', credentials=scoped_credentials, static_discovery=True, cache_discovery=False) as service:
             user_info = service.userinfo().v2().me().get().execute()
             typer.echo(f"Successfully authenticated with user: {user_info['id']}")
     except BaseException as e:
@@ -144,7 +159,7 @@ def extract(report: Optional[Path] = typer.Option("report.json", dir_okay=True))
         typer.echo("Config file doesn't exist yet. Please run 'setup' command first.")
         typer.Exit(2)
     with config_path.open() as file:
-        config = yaml.safe_load(file)
+        config = yaml.load(file, Loader=SafeLoader)
         credentials = service_account.Credentials.from_service_account_file(config["serviceAccountKeyPath"])
         scoped_credentials = credentials.with_scopes(['https://www.googleapis.com/auth/analytics.readonly'])
 
@@ -163,19 +178,20 @@ def extract(report: Optional[Path] = typer.Option("report.json", dir_okay=True))
                         "metrics": [metrics],
                         "samplingLevel": config['samplingLevel']
                     }]}
-        rows = []
-        with build('analyticsreporting', 'v4', credentials=scoped_credentials) as service:
-            response = service.reports().batchGet(body=body).execute()
-            if not "rows" in response.values():
+        with AuthorizedSession(scoped_credentials) as session:  # Keeps connection alive across pages
+            reports = __report_pages(session, body)
+            report = next(reports)
+            if "rows" not in report["data"]:
                 raise Exception("There were no rows in the response.")
-            rows.extend(response["reports"][0]["data"]["rows"])
-
-            while "nextPageToken" in response["reports"][0]:  # Paging...
-                body["reportRequests"][0]["pageToken"] = response["reports"][0]["nextPageToken"]
-                response = service.reports().batchGet(body=body).execute()
-                rows.extend(response["reports"][0]["data"]["rows"])
 
-            output_path.write_text(json.dumps(rows))
+            with __atomic_open(output_path, mode="wb") as f:  # Rows are streamed as JSON array, page by page
+                f.write(b"[")
+                pages = itertools.chain([report], reports)  # Paging...
+                for i, row in enumerate(itertools.chain.from_iterable(r["data"].get("rows", []) for r in pages)):
+                    if i > 0:
+                        f.write(b",")
+                    f.write(orjson.dumps(row))
+                f.write(b"]")
         typer.echo(f"Report written to {output_path.absolute()}")
 
 
@@ -200,7 +216,7 @@ def migrate(output_format: OutputFormat = typer.Option(OutputFormat.JSON, "--for
         typer.echo("Config file doesn't exist yet. Please run 'setup' command first.")
         typer.Exit(2)
     with config_path.open() as file:
-        config = yaml.safe_load(file)
+        config = yaml.load(file, Loader=SafeLoader)
         credentials = service_account.Credentials.from_service_account_file(config["serviceAccountKeyPath"])
         scoped_credentials = credentials.with_scopes(['https://www.googleapis.com/auth/analytics.readonly'])
 
@@ -208,85 +224,115 @@ def migrate(output_format: OutputFormat = typer.Option(OutputFormat.JSON, "--for
         rows = __migrate_extract(scoped_credentials, config['table'], date_ranges)
 
         if output_format == OutputFormat.UMAMI:
-            data = __migrate_transform_umami(rows, umami_website_id, umami_hostname)
-            with output_path.open(mode="w") as f:
-                for insert in data:
-                    f.write(f"{insert}\n")
+            with __atomic_open(output_path, mode="w") as f:
+                __migrate_transform_umami(rows, umami_website_id, umami_hostname, f)
         elif output_format == OutputFormat.JSON:
-            output_path.write_text(json.dumps(rows))
+            with __atomic_open(output_path, mode="wb") as f:
+                f.write(orjson.dumps(rows))
         elif output_format == OutputFormat.CSV:
-            data = __migrate_transform_csv(rows)
-            with output_path.open(mode="w") as f:
-                for row in data:
-                    f.write(f"{row}\n")
+            with __atomic_open(output_path, mode="w", newline="") as f:
+                __migrate_transform_csv(rows, f)
 
         typer.echo(f"Report written to {output_path.absolute()}")
 
 
+@contextmanager
+def __atomic_open(path, mode, **kwargs):
+    # Output is written to temporary file (with large buffer) and moved into place only once complete
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    try:
+        with tmp_path.open(mode=mode, buffering=1 << 20, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
 def __migrate_date_ranges(start_date, end_date):
-    start_date = datetime.strptime(start_date, '%Y-%m-%d')
-    end_date = datetime.strptime(end_date, '%Y-%m-%d')
-    date_ranges = [{"startDate": f"{start_date + timedelta(days=d):%Y-%m-%d}",
-                    "endDate": f"{start_date + timedelta(days=d):%Y-%m-%d}"} for d in
-                   range(((end_date.date() - start_date.date()).days + 1))]
+    start_date = date.fromisoformat(start_date)
+    end_date = date.fromisoformat(end_date)
+    days = [date.fromordinal(o).isoformat() for o in range(start_date.toordinal(), end_date.toordinal() + 1)]
+    date_ranges = [{"startDate": day, "endDate": day} for day in days]
     return date_ranges
 
 
 def __migrate_extract(credentials, table_id, date_ranges):
-    dimensions = ["ga:pagePath", "ga:browser", "ga:operatingSystem", "ga:deviceCategory", "ga:browserSize", "ga:language", "ga:country", "ga:fullReferrer"]
+    dimensions = ["ga:date", "ga:pagePath", "ga:browser", "ga:operatingSystem", "ga:deviceCategory", "ga:browserSize", "ga:language", "ga:country", "ga:fullReferrer"]
     metrics = ["ga:pageviews", "ga:sessions"]
 
+    rows = {r["startDate"]: [] for r in date_ranges}
+    if not date_ranges:  # Start date is after end date
+        return rows
+
+    # batchGet requires all report requests to share the same dateRanges, so instead of one request per day,
+    # whole range is requested at once and rows are split by the "ga:date" dimension
     body = {"reportRequests": [
         {
             "viewId": f"{table_id}",
+            "dateRanges": [{"startDate": date_ranges[0]["startDate"], "endDate": date_ranges[-1]["endDate"]}],
             "dimensions": [{"name": d} for d in dimensions],
-            "metrics": [{"expression": m} for m in metrics]
+            "metrics": [{"expression": m} for m in metrics],
+            "pageSize": 100000
         }]}
 
-    rows = {}
-    for r in date_ranges:
-        with build('analyticsreporting', 'v4', credentials=credentials) as service:
-            body["reportRequests"][0]["dateRanges"] = [r]
-            response = service.reports().batchGet(body=body).execute()
-
-            rows[r["startDate"]] = response["reports"][0]["data"]["rows"]
+    with AuthorizedSession(credentials) as session:
+        reports = __report_pages(session, body)
+        report = next(reports)
+        if "samplesReadCounts" in report["data"]:
+            # GA sampled the whole range, fall back to per-day requests to keep day-level data accurate
+            request = {**body["reportRequests"][0], "dimensions": [{"name": d} for d in dimensions[1:]]}
+
+            def extract_day(r):
+                day_body = {"reportRequests": [{**request, "dateRanges": [r]}]}
+                return [row for day_report in __report_pages(session, day_body) for row in day_report["data"].get("rows", [])]
+
+            # The requests session is shared across threads on purpose (requests.Session isn't documented as thread-safe,
+            # but its connection pool is); concurrent token refreshes on expiry/401 are possible, just redundant
+            with ThreadPoolExecutor(max_workers=10) as executor:  # Reporting API allows 10 concurrent requests per view
+                for r, day_rows in zip(date_ranges, executor.map(extract_day, date_ranges)):
+                    rows[r["startDate"]] = day_rows
+            return rows
+
+        for report in itertools.chain([report], reports):
+            for row in report["data"].get("rows", []):
+                day = row["dimensions"][0]  # YYYYMMDD
+                rows[f"{day[:4]}-{day[4:6]}-{day[6:]}"].append({"dimensions": row["dimensions"][1:], "metrics": row["metrics"]})
 
     return rows
 
 
-class Session(NamedTuple):
-    session_id: int
-    session_uuid: uuid.UUID
-    website_id: int
-    created_at: str
-    hostname: str
-    browser: str
-    os: str
-    device: str
-    screen: str
-    language: str
+def __report_pages(session, body):
+    response = __batch_get(session, body)
+    report = response["reports"][0]
+    yield report
 
-    def sql(self):
-        session_insert = (
-            f"INSERT INTO public.session (session_id, session_uuid, website_id, created_at, hostname, browser, os, device, screen, language, country) "
-            f"VALUES ({self.session_id}, '{self.session_uuid}', {self.website_id}, '{self.created_at}', '{self.hostname}', '{self.browser[:20]}', '{self.os}', '{self.device}', '{self.screen}', '{self.language}', NULL);"
-        )
-        return session_insert
+    while report.get("nextPageToken"):  # Paging...
+        body["reportRequests"][0]["pageToken"] = report["nextPageToken"]
+        response = __batch_get(session, body)
+        report = response["reports"][0]
+        yield report
+    body["reportRequests"][0].pop("pageToken", None)
 
 
-class PageView(NamedTuple):
-    id: int
-    website_id: int
-    session_id: int
-    created_at: str
-    url: str
-    referral_path: str
+def __batch_get(session, body):
+    response = session.post(BATCH_GET_URL, json=body)
+    if not response.ok:  # Surface GA's own reason (bad view ID, missing permissions, ...) instead of bare status
+        try:
+            message = response.json().get("error", {}).get("message")
+        except ValueError:
+            message = None
+        raise requests.HTTPError(f"{response.status_code} {response.reason}: {message or response.text}", response=response)
+    return response.json()
 
-    def sql(self):
-        return f"INSERT INTO public.pageview (view_id, website_id, session_id, created_at, url, referrer) VALUES ({self.id}, {self.website_id}, {self.session_id}, '{self.created_at}', '{self.url}', '{self.referral_path}');"
 
+SESSION_SQL = "INSERT INTO public.session (session_id, session_uuid, website_id, created_at, hostname, browser, os, device, screen, language, country) VALUES "
+SESSION_VALUES = "(%s, '%s', {website_id}, '%s', '{hostname}', '%s', '%s', '%s', '%s', '%s', NULL)"
+PAGEVIEW_SQL = "INSERT INTO public.pageview (view_id, website_id, session_id, created_at, url, referrer) VALUES "
+PAGEVIEW_VALUES = "(%s, {website_id}, %s, '%s', '%s', '%s')"
 
-def __migrate_transform_umami(rows,  website_id, hostname):
+
+def __migrate_transform_umami(rows, website_id, hostname, out_fp):
 
     # Sample row:
     # {'dimensions': ['/', 'Chrome', 'Windows', 'desktop', '1350x610', 'en-us', 'India', '(direct)'], 'metrics': [{'values': ['1', '1']}]}
@@ -298,62 +344,55 @@ def __migrate_transform_umami(rows,  website_id, hostname):
     #           - 4, 2 - 2 sessions, 2 views each
     #           - 5, 3 - 3 sessions, 2x1 view, 1x3 views
 
+    # Entropy for all session UUIDs is read at once instead of calling uuid.uuid4() (and os.urandom) per session
+    total_sessions = sum(max(int(row["metrics"][0]["values"][1]), 1) for value in rows.values() for row in value)
+    entropy = os.urandom(16 * total_sessions)
+    session_uuids = (uuid.UUID(bytes=entropy[i:i + 16], version=4) for i in range(0, len(entropy), 16))
+
+    # website_id and hostname are the same for every insert, so they're baked into templates just once
+    session_values_sql = SESSION_VALUES.format(website_id=website_id, hostname=hostname.replace("%", "%%"))
+    pageview_values_sql = PAGEVIEW_VALUES.format(website_id=website_id)
+
     page_view_id = 1
     session_id = 1
-    sql_inserts = []
     for day, value in rows.items():
+        timestamp = f"{day} 00:00:00.000+00"  # PostgreSQL-style "timestamp with timezone"
         for row in value:
-            timestamp = f"{day} 00:00:00.000+00"  # PostgreSQL-style "timestamp with timezone"
-            referrer = f"https://{row['dimensions'][7]}"
+            # Everything except IDs and UUID is the same for all sessions/views generated from single row
+            url, browser, os_name, device, screen, language, _, referrer = row["dimensions"]
+            referrer = f"https://{referrer}"
             if not validators.url(referrer):
                 referrer = ""
             elif referrer == "google":
                 referrer = "https://google.com"
 
-            language = row["dimensions"][5][:2]
+            # created_at, browser, os, device, screen, language
+            session_values = (timestamp, browser[:20], os_name, device, screen, language[:2])
+
+            # Sessions and views of single row are each inserted with one multi-row INSERT (sessions first, views reference them)
+            session_rows = []
+            view_rows = []
             page_views, sessions = map(int, row["metrics"][0]["values"])
             sessions = max(sessions, 1)  # in case it's zero
-            if page_views == sessions:  # One page view for each session
-                for i in range(sessions):
-                    s = Session(session_uuid=uuid.uuid4(), session_id=session_id, website_id=website_id, created_at=timestamp, hostname=hostname,
-                                browser=row["dimensions"][1], os=row["dimensions"][2], device=row["dimensions"][3], screen=row["dimensions"][4],
-                                language=language)
-                    p = PageView(id=page_view_id, website_id=website_id, session_id=session_id, created_at=timestamp, url=row["dimensions"][0], referral_path=referrer)
-                    sql_inserts.extend([s.sql(), p.sql()])
-                    session_id += 1
+            views_per_session, remainder = divmod(page_views, sessions)
+            if remainder:  # One page view for each, rest for the last session
+                session_views = [1] * (sessions - 1) + [1 + max(page_views - sessions, 0)]
+            else:  # Split equally (one page view for each session if counts are equal)
+                session_views = [views_per_session] * sessions
+
+            for views in session_views:
+                session_rows.append(session_values_sql % (session_id, next(session_uuids), *session_values))
+                for i in range(views):
+                    view_rows.append(pageview_values_sql % (page_view_id, session_id, timestamp, url, referrer))
                     page_view_id += 1
+                session_id += 1
 
-            elif page_views % sessions == 0:  # Split equally
-                for i in range(sessions):
-                    s = Session(session_uuid=uuid.uuid4(), session_id=session_id, website_id=website_id, created_at=timestamp, hostname=hostname,
-                                browser=row["dimensions"][1], os=row["dimensions"][2], device=row["dimensions"][3], screen=row["dimensions"][4],
-                                language=language)
-                    sql_inserts.append(s.sql())
-                    for j in range(page_views // sessions):
-                        p = PageView(id=page_view_id, website_id=website_id, session_id=session_id, created_at=timestamp, url=row["dimensions"][0], referral_path=referrer)
-                        sql_inserts.append(p.sql())
-                        page_view_id += 1
-                    session_id += 1
-            else:  # One page view for each, rest for the last session
-                for i in range(sessions):
-                    s = Session(session_uuid=uuid.uuid4(), session_id=session_id, website_id=website_id, created_at=timestamp, hostname=hostname,
-                                browser=row["dimensions"][1], os=row["dimensions"][2], device=row["dimensions"][3], screen=row["dimensions"][4],
-                                language=language)
-                    p = PageView(id=page_view_id, website_id=website_id, session_id=session_id, created_at=timestamp, url=row["dimensions"][0], referral_path=referrer)
-                    sql_inserts.extend([s.sql(), p.sql()])
-                    session_id += 1
-                    page_view_id += 1
-                last_session_id = session_id - 1
-                for i in range(page_views - sessions):
-                    p = PageView(id=page_view_id, website_id=website_id, session_id=last_session_id, created_at=timestamp, url=row["dimensions"][0], referral_path=referrer)
-                    page_view_id += 1
-                    sql_inserts.append(p.sql())
+            out_fp.write(f"{SESSION_SQL}{', '.join(session_rows)};\n")
+            if view_rows:
+                out_fp.write(f"{PAGEVIEW_SQL}{', '.join(view_rows)};\n")
 
-    sql_inserts.extend([
-        f"SELECT pg_catalog.setval('public.pageview_view_id_seq', {page_view_id}, true);",
-        f"SELECT pg_catalog.setval('public.session_session_id_seq', {session_id}, true);"
-    ])
-    return sql_inserts
+    out_fp.write(f"SELECT pg_catalog.setval('public.pageview_view_id_seq', {page_view_id}, true);\n")
+    out_fp.write(f"SELECT pg_catalog.setval('public.session_session_id_seq', {session_id}, true);\n")
 
 
 class CSVRow(NamedTuple):
@@ -368,28 +407,9 @@ class CSVRow(NamedTuple):
     count: str
     date: datetime.date
 
-    @staticmethod
-    def header():
-        return f"path,browser,os,device,screen,language,country,referral_path,count,date"
-
-    def csv(self):
-        return f"{self.path},{self.browser},{self.os},{self.device},{self.screen},{self.language},{self.country},{self.referral_path},{self.count},{self.date}"
 
-
-def __migrate_transform_csv(rows):
-    csv_rows = [CSVRow.header()]
-    for day, value in rows.items():
-        for row in value:
-            page_views, _ = map(int, row["metrics"][0]["values"])
-            row = CSVRow(path=row["dimensions"][0],
-                         browser=row["dimensions"][1],
-                         os=row["dimensions"][2],
-                         device=row["dimensions"][3],
-                         screen=row["dimensions"][4],
-                         language=row["dimensions"][5],
-                         country=row["dimensions"][6],
-                         referral_path=row["dimensions"][7],
-                         count=page_views,
-                         date=day)
-            csv_rows.append(row.csv())
-    return csv_rows
+def __migrate_transform_csv(rows, out_fp):
+    writer = csv.writer(out_fp, lineterminator="\n")
+    writer.writerow(CSVRow._fields)
+    writer.writerows(CSVRow(*row["dimensions"], count=int(row["metrics"][0]["values"][0]), date=day)
+                     for day, value in rows.items() for row in value)
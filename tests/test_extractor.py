@@ -1,16 +1,27 @@
+import copy
+import io
+import json
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+import yaml
 from typer.testing import CliRunner
 
-from ga_extractor.extractor import __migrate_transform_umami, __migrate_transform_csv, __migrate_date_ranges
+from ga_extractor.extractor import extractor, __migrate_transform_umami, __migrate_transform_csv, __migrate_date_ranges, __migrate_extract, \
+    __atomic_open
 
 runner = CliRunner()
 
 
 def test__migrate_transform_umami(sample_extract):
-    sql = __migrate_transform_umami(sample_extract, 1, "localhost")
-    assert len(sql) == 25
-    assert sum(1 if row.startswith("INSERT INTO public.session") else 0 for row in sql) == 10  # Sessions
-    assert sum(1 if row.startswith("INSERT INTO public.pageview") else 0 for row in sql) == 13  # Sessions
-    assert sum(1 if "/blog/68" in row else 0 for row in sql) == 3
+    out = io.StringIO()
+    __migrate_transform_umami(sample_extract, 1, "localhost", out)
+    sql = out.getvalue().splitlines()
+    assert len(sql) == 10  # One session and one page view INSERT per row + 2 sequence updates
+    assert sum(row.count("'localhost'") for row in sql if row.startswith("INSERT INTO public.session")) == 10  # Sessions
+    assert sum(row.count("00:00:00.000+00") for row in sql if row.startswith("INSERT INTO public.pageview")) == 13  # Page views
+    assert sum(row.count("/blog/68") for row in sql) == 3
 
 
 def test__migrate_transform_csv(sample_extract):
@@ -20,9 +31,10 @@ def test__migrate_transform_csv(sample_extract):
                 '/blog/51,Chrome,Macintosh,desktop,1540x850,en-us,United States,(direct),4,2022-03-19',
                 '/blog/68,Firefox,Android,mobile,410x780,es-us,Colombia,betterprogramming.pub/building-github-apps-with-golang-43b27f3e9621,3,2022-03-19']
 
-    csv_rows = __migrate_transform_csv(sample_extract)
+    out = io.StringIO()
+    __migrate_transform_csv(sample_extract, out)
 
-    assert csv_rows == expected
+    assert out.getvalue() == "".join(f"{row}\n" for row in expected)
 
 
 def test__migrate_date_ranges():
@@ -33,3 +45,111 @@ def test__migrate_date_ranges():
     date_ranges = __migrate_date_ranges("2022-03-17", "2022-03-19")
 
     assert date_ranges == expected
+
+
+def test__migrate_extract(sample_extract):
+    date_ranges = __migrate_date_ranges("2022-03-18", "2022-03-19")
+    response = {"reports": [{"data": {"rows": [
+        {"dimensions": ["20220319", *row["dimensions"]], "metrics": row["metrics"]} for row in sample_extract["2022-03-19"]
+    ]}}]}
+
+    with patch("ga_extractor.extractor.AuthorizedSession") as session:
+        session.return_value.__enter__.return_value.post.return_value.json.return_value = response
+        rows = __migrate_extract(None, 123456789, date_ranges)
+
+    assert rows == {"2022-03-18": [], **sample_extract}
+
+
+def test__migrate_extract_empty_range():
+    date_ranges = __migrate_date_ranges("2022-03-19", "2022-03-17")
+
+    with patch("ga_extractor.extractor.AuthorizedSession") as session:
+        rows = __migrate_extract(None, 123456789, date_ranges)
+
+    assert rows == {}
+    session.assert_not_called()
+
+
+def test__migrate_extract_error_message():
+    date_ranges = __migrate_date_ranges("2022-03-18", "2022-03-19")
+    error = {"error": {"code": 403, "message": "User does not have sufficient permissions for this profile.", "status": "PERMISSION_DENIED"}}
+
+    with patch("ga_extractor.extractor.AuthorizedSession") as session:
+        session.return_value.__enter__.return_value.post.return_value = Mock(ok=False, status_code=403, reason="Forbidden",
+                                                                             **{"json.return_value": error})
+        with pytest.raises(requests.HTTPError, match="403 Forbidden: User does not have sufficient permissions for this profile."):
+            __migrate_extract(None, 123456789, date_ranges)
+
+
+def test__migrate_extract_sampled(sample_extract):
+    date_ranges = __migrate_date_ranges("2022-03-18", "2022-03-19")
+
+    def batch_get(url, json):
+        request = json["reportRequests"][0]
+        if request["dimensions"][0]["name"] == "ga:date":  # Whole range
+            return Mock(**{"json.return_value": {"reports": [{"data": {"rows": [], "samplesReadCounts": ["1"]}}]}})
+        day_rows = sample_extract.get(request["dateRanges"][0]["startDate"], [])
+        return Mock(**{"json.return_value": {"reports": [{"data": {"rows": day_rows}}]}})
+
+    with patch("ga_extractor.extractor.AuthorizedSession") as session:
+        session.return_value.__enter__.return_value.post.side_effect = batch_get
+        rows = __migrate_extract(None, 123456789, date_ranges)
+
+    assert rows == {"2022-03-18": [], **sample_extract}
+
+
+def extract_pages(tmp_path, pages):
+    config = {"serviceAccountKeyPath": "key.json", "table": 123456789, "metrics": ["ga:pageviews"], "dimensions": ["ga:pagePath"],
+              "samplingLevel": "DEFAULT", "startDate": "2022-03-17", "endDate": "2022-03-19"}
+    (tmp_path / "config.yaml").write_text(yaml.dump(config))
+
+    with patch("typer.get_app_dir", return_value=str(tmp_path)), \
+            patch("google.oauth2.service_account.Credentials.from_service_account_file"), \
+            patch("ga_extractor.extractor.AuthorizedSession") as session:
+        bodies = []  # Request body is modified between pages, so copy is kept for each call
+
+        def batch_get(url, json):
+            bodies.append(copy.deepcopy(json))
+            return Mock(**{"json.return_value": pages[len(bodies) - 1]})
+
+        session.return_value.__enter__.return_value.post.side_effect = batch_get
+        result = runner.invoke(extractor, ["extract"])
+
+    assert result.exit_code == 0, result.output
+    return bodies, json.loads((tmp_path / "report.json").read_text())
+
+
+def test_extract(tmp_path):
+    pages = [{"reports": [{"data": {"rows": [{"dimensions": ["/"], "metrics": [{"values": ["1"]}]},
+                                             {"dimensions": ["/blog/69"], "metrics": [{"values": ["5"]}]}]}, "nextPageToken": "2"}]},
+             {"reports": [{"data": {"rows": [{"dimensions": ["/blog/68"], "metrics": [{"values": ["3"]}]}]}}]}]
+
+    bodies, report = extract_pages(tmp_path, pages)
+
+    assert report == pages[0]["reports"][0]["data"]["rows"] + pages[1]["reports"][0]["data"]["rows"]
+    assert not list(tmp_path.glob("*.tmp"))
+    assert "pageToken" not in bodies[0]["reportRequests"][0]
+    assert bodies[1]["reportRequests"][0]["pageToken"] == "2"
+
+
+@pytest.mark.parametrize("token", [None, ""])
+def test_extract_last_page_token(tmp_path, token):
+    pages = [{"reports": [{"data": {"rows": [{"dimensions": ["/"], "metrics": [{"values": ["1"]}]}]}, "nextPageToken": token}]}]
+
+    bodies, report = extract_pages(tmp_path, pages)
+
+    assert len(bodies) == 1
+    assert report == pages[0]["reports"][0]["data"]["rows"]
+
+
+def test__atomic_open_failure(tmp_path):
+    output_path = tmp_path / "report.json"
+    output_path.write_text("previous report")
+
+    with pytest.raises(RuntimeError):
+        with __atomic_open(output_path, mode="w") as f:
+            f.write("partial report")
+            raise RuntimeError("Extraction failed")
+
+    assert output_path.read_text() == "previous report"
+    assert not list(tmp_path.glob("*.tmp"))